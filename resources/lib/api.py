@@ -5,6 +5,15 @@ from urllib.error import URLError, HTTPError
 
 from resources.lib.utils import get_setting, log_error, BASE_URL
 
+IMPORT_FORMAT_LEGACY = 'legacy'
+IMPORT_FORMAT_GROUPED = 'grouped'
+
+# Status codes meaning an endpoint doesn't exist on this server
+UNSUPPORTED_CODES = (404, 405)
+
+# Status codes meaning the server refused the content of a request
+REJECTED_CODES = (400, 422)
+
 
 class BingebaseAPI:
     def __init__(self):
@@ -19,7 +28,7 @@ class BingebaseAPI:
         if auth and self.token:
             headers['Authorization'] = 'Bearer {}'.format(self.token)
 
-        body = json.dumps(data).encode('utf-8') if data is not None else None
+        body = json.dumps(data, separators=(',', ':')).encode('utf-8') if data is not None else None
         req = Request(url, data=body, headers=headers, method=method)
         try:
             response = urlopen(req, timeout=30)
@@ -42,11 +51,36 @@ class BingebaseAPI:
             return None
         return self._request(self.webhook_url, data=payload, auth=False)
 
+    def get_import_formats(self):
+        """Import payload formats the server accepts. Servers that predate
+        the capabilities endpoint only accept the legacy format."""
+        url = '{}/api/v1/kodi/capabilities'.format(BASE_URL)
+        try:
+            capabilities = self._request(url) or {}
+        except HTTPError as e:
+            if e.code not in UNSUPPORTED_CODES:
+                raise
+            return [IMPORT_FORMAT_LEGACY]
+        return capabilities.get('import_formats') or [IMPORT_FORMAT_LEGACY]
+
     def import_history(self, movies, episodes):
         url = '{}/api/v1/kodi/import'.format(BASE_URL)
         payload = {'movies': movies, 'episodes': episodes}
         return self._request(url, data=payload)
 
+    def import_history_grouped(self, movies, shows):
+        """Import using the grouped format: one entry per show with compact
+        [season, episode, playcount, lastplayed] rows."""
+        url = '{}/api/v1/kodi/import'.format(BASE_URL)
+        payload = {'format': IMPORT_FORMAT_GROUPED, 'movies': movies, 'shows': shows}
+        return self._request(url, data=payload)
+
+    def remove_history(self, items):
+        """Send items un-watched in Kodi. The server may answer with the
+        highest sequence number it stored as 'ack'."""
+        url = '{}/api/v1/kodi/unwatch'.format(BASE_URL)
+        return self._request(url, data={'items': items})
+
     def export_history(self, since=None):
         url = '{}/api/v1/kodi/export'.format(BASE_URL)
         if since:
@@ -0,0 +1,78 @@
+import threading
+import time
+
+import xbmc
+
+from resources.lib.utils import log
+
+# JSON-RPC page size and formatting chunk size at full speed and while a
+# video is playing
+FULL_BATCH_SIZE = 500
+THROTTLED_BATCH_SIZE = 50
+
+# Pause at each checkpoint while throttled, in seconds
+THROTTLE_DELAY = 0.25
+
+
+class SyncAborted(Exception):
+    """Raised at a checkpoint when sync was cancelled or Kodi is exiting."""
+
+
+class SyncGovernor:
+    """Cooperative throttle for sync work.
+
+    Sync phases call checkpoint() between JSON-RPC pages and formatting
+    chunks and size their batches with batch_size(). While a video is
+    playing each checkpoint yields for a moment and batches shrink, so
+    playback on slow devices isn't starved. Full speed resumes as soon as
+    playback stops. Checkpoints also raise SyncAborted once the sync is
+    cancelled or Kodi is shutting down.
+    """
+
+    def __init__(self, player=None, monitor=None):
+        self.player = player or xbmc.Player()
+        self.monitor = monitor or xbmc.Monitor()
+        self.throttled_time = 0.0
+        self.throttled_checkpoints = 0
+        # Checkpoints may come from several pipeline threads at once, so
+        # throttled time is measured as wall-clock time between any two
+        self._lock = threading.Lock()
+        self._last_checkpoint = time.time()
+        self._throttled = False
+        self._cancelled = threading.Event()
+
+    def is_throttled(self):
+        return self.player.isPlayingVideo()
+
+    def batch_size(self):
+        return THROTTLED_BATCH_SIZE if self.is_throttled() else FULL_BATCH_SIZE
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def check_cancelled(self):
+        if self._cancelled.is_set() or self.monitor.abortRequested():
+            raise SyncAborted()
+
+    def _account(self, throttled):
+        with self._lock:
+            now = time.time()
+            if self._throttled:
+                self.throttled_time += now - self._last_checkpoint
+            self._last_checkpoint = now
+            self._throttled = throttled
+            if throttled:
+                self.throttled_checkpoints += 1
+
+    def checkpoint(self):
+        self.check_cancelled()
+        throttled = self.is_throttled()
+        self._account(throttled)
+        if throttled:
+            self.monitor.waitForAbort(THROTTLE_DELAY)
+
+    def log_metrics(self):
+        self._account(False)
+        if self.throttled_checkpoints:
+            log('Sync throttled for {:.1f}s during playback ({} checkpoints)'.format(
+                self.throttled_time, self.throttled_checkpoints))
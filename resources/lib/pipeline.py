@@ -0,0 +1,77 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_EXCEPTION, wait
+
+# Formatted chunks allowed to wait for upload
+PIPELINE_DEPTH = 2
+
+# How often blocked queue operations re-check for cancellation, in seconds
+QUEUE_TIMEOUT = 0.5
+
+_DONE = object()
+
+
+def run_parallel(governor, *funcs):
+    """Run independent stages (e.g. an HTTP download and library reads) on
+    worker threads and return their results in order.
+
+    As soon as any stage fails the governor is cancelled, so the remaining
+    stages stop at their next checkpoint, and the error is re-raised. While
+    a video is playing the stages run one after another instead.
+    """
+    if governor.is_throttled():
+        return [func() for func in funcs]
+
+    with ThreadPoolExecutor(max_workers=len(funcs)) as executor:
+        futures = [executor.submit(func) for func in funcs]
+        done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+        for future in done:
+            if future.exception() is not None:
+                governor.cancel()
+                raise future.exception()
+        return [future.result() for future in futures]
+
+
+def run_pipeline(chunks, consume, governor):
+    """Produce chunks on the calling thread while a worker consumes them.
+
+    The queue between the two is bounded, so producing never runs more than
+    PIPELINE_DEPTH chunks ahead of consuming (e.g. chunk N uploads while
+    chunk N+1 is formatted). An error on either side stops the other.
+    """
+    chunk_queue = queue.Queue(maxsize=PIPELINE_DEPTH)
+    stopped = threading.Event()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(_drain, chunk_queue, consume, governor, stopped)
+        try:
+            for chunk in chunks:
+                _put(chunk_queue, chunk, future, governor)
+            _put(chunk_queue, _DONE, future, governor)
+            return future.result()
+        except BaseException:
+            stopped.set()
+            raise
+
+
+def _put(chunk_queue, item, future, governor):
+    while not future.done():
+        governor.check_cancelled()
+        try:
+            chunk_queue.put(item, timeout=QUEUE_TIMEOUT)
+            return
+        except queue.Full:
+            pass
+    # The consumer stopped early; surface its error
+    future.result()
+
+
+def _drain(chunk_queue, consume, governor, stopped):
+    while not stopped.is_set():
+        governor.check_cancelled()
+        try:
+            item = chunk_queue.get(timeout=QUEUE_TIMEOUT)
+        except queue.Empty:
+            continue
+        if item is _DONE:
+            return
+        consume(item)
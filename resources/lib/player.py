@@ -1,7 +1,7 @@
 import xbmc
 
 from resources.lib.utils import (
-    get_setting_bool, get_setting_int, get_show_uniqueids,
+    get_setting_bool, get_setting_int, get_show_uniqueids, format_show_uniqueids,
     log, log_error, notify
 )
 
@@ -116,12 +116,7 @@ class BingebasePlayer(xbmc.Player):
             info['episode'] = info_tag.getEpisode()
 
             # Get show-level IDs from parent TV show
-            show_uids = get_show_uniqueids(info_tag.getDbId())
-            info['showUniqueIds'] = {
-                'tmdb': show_uids.get('tmdb', ''),
-                'tvdb': show_uids.get('tvdb', ''),
-                'imdb': show_uids.get('imdb', ''),
-            }
+            info['showUniqueIds'] = format_show_uniqueids(get_show_uniqueids(info_tag.getDbId()))
 
         return info
 
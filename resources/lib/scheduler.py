@@ -0,0 +1,98 @@
+import random
+import time
+
+import xbmc
+
+from resources.lib.utils import get_setting, set_setting, get_sync_interval_hours, log
+
+# Each device shifts its runs by a stable offset of up to this fraction of
+# the interval, so devices sharing the same interval setting sync apart
+JITTER_FRACTION = 0.1
+
+# While the screensaver is on, a run may start this early; a run overdue by
+# this much goes ahead even during playback, throttled by SyncGovernor
+IDLE_WINDOW = 3600  # 1 hour
+
+# Stored as the next run while scheduled sync is off
+SCHEDULE_OFF = -1
+
+
+def _is_screensaver_active():
+    return xbmc.getCondVisibility('System.ScreenSaverActive')
+
+
+def _get_device_offset():
+    """This device's jitter, as a fraction of the interval. Picked at random
+    once and then kept."""
+    try:
+        return float(get_setting('sync_offset'))
+    except ValueError:
+        offset = random.uniform(-JITTER_FRACTION, JITTER_FRACTION)
+        set_setting('sync_offset', offset)
+        return offset
+
+
+class SyncScheduler:
+    """Scheduled sync with a persisted next-run time.
+
+    The next run survives restarts, so a missed run is caught up once on the
+    next check rather than being replayed per missed interval. With no run
+    stored yet (fresh install or upgrade) a run is due right away. Runs are
+    deferred while something is playing, for up to IDLE_WINDOW, and pulled
+    forward while idle.
+    """
+
+    def __init__(self, player=None):
+        self.player = player
+        self.next_run = 0
+        self.reload()
+
+    def reload(self):
+        try:
+            self.next_run = int(get_setting('next_sync_time') or 0)
+        except ValueError:
+            self.next_run = 0
+
+    def _interval(self):
+        return get_sync_interval_hours() * 3600
+
+    def _is_playing(self):
+        player = self.player or xbmc.Player()
+        return player.isPlaying()
+
+    def schedule_next(self, now=None):
+        """Schedule the next run one interval plus this device's offset from now."""
+        interval = self._interval()
+        if interval == 0:
+            self.next_run = SCHEDULE_OFF
+        else:
+            now = now or time.time()
+            self.next_run = int(now + interval * (1 + _get_device_offset()))
+        set_setting('next_sync_time', self.next_run)
+
+    def should_run(self, now=None):
+        interval = self._interval()
+        if interval == 0:
+            # Forget the old schedule so turning it back on starts afresh
+            if self.next_run != SCHEDULE_OFF:
+                self.schedule_next()
+            return False
+
+        now = now or time.time()
+        if self.next_run == SCHEDULE_OFF or self.next_run > now + interval * (1 + JITTER_FRACTION):
+            # Scheduling was just turned on, or the interval was shortened
+            log('Scheduling sync')
+            self.schedule_next(now)
+            return False
+
+        if not self.next_run:
+            # Nothing stored yet, so catch up now
+            self.next_run = int(now)
+
+        if now >= self.next_run + IDLE_WINDOW:
+            return True
+        if self._is_playing():
+            return False
+        if now >= self.next_run:
+            return True
+        return now >= self.next_run - IDLE_WINDOW and _is_screensaver_active()
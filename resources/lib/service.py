@@ -1,15 +1,13 @@
+import json
 import sys
-import time
 
 import xbmc
 
 from resources.lib.utils import (
-    get_setting, get_setting_bool, get_sync_interval_hours,
-    log, log_error, notify, reload_addon
+    get_setting, get_setting_bool,
+    log, log_error, notify, reload_addon, ADDON_ID
 )
 
-POLL_INTERVAL = 300  # 5 minutes
-
 
 class BingebaseMonitor(xbmc.Monitor):
     def __init__(self, service):
@@ -20,8 +18,31 @@ class BingebaseMonitor(xbmc.Monitor):
         log('Settings changed, reloading')
         reload_addon()
         self.service.reload_api()
+        self.service.reload_scheduler()
         self.service.check_token_changed()
 
+    def onNotification(self, sender, method, data):
+        if sender == ADDON_ID and method == 'Other.sync_now':
+            log('Sync requested')
+            self.service.trigger_sync()
+            return
+
+        if method != 'VideoLibrary.OnUpdate' or not get_setting_bool('sync_kodi_to_bingebase'):
+            return
+        try:
+            data = json.loads(data)
+        except ValueError:
+            return
+        item = data.get('item', {})
+        if 'playcount' not in data or item.get('type') not in ('movie', 'episode'):
+            return
+
+        from resources.lib.tombstones import record_unwatched, record_watched
+        if data['playcount'] == 0:
+            record_unwatched(item['type'], item['id'])
+        else:
+            record_watched(item['type'], item['id'])
+
     def onScanFinished(self, library):
         if library == 'video' and get_setting_bool('sync_on_library_update'):
             log('Library scan finished, triggering sync')
@@ -33,7 +54,7 @@ class BingebaseService:
         self.api = None
         self.player = None
         self.monitor = None
-        self.last_sync_time = 0
+        self.scheduler = None
         self._sync_requested = False
         self._last_known_token = ''
 
@@ -47,6 +68,10 @@ class BingebaseService:
         else:
             self.api = None
 
+    def reload_scheduler(self):
+        if self.scheduler:
+            self.scheduler.reload()
+
     def check_token_changed(self):
         token = get_setting('access_token')
         if token and token != self._last_known_token:
@@ -63,20 +88,14 @@ class BingebaseService:
         try:
             from resources.lib.sync import do_sync
             do_sync(self.api)
-            self.last_sync_time = time.time()
         except Exception:
             log_error('Sync error')
-
-    def _should_scheduled_sync(self):
-        interval_hours = get_sync_interval_hours()
-        if interval_hours == 0:
-            return False
-
-        elapsed = time.time() - self.last_sync_time
-        return elapsed >= (interval_hours * 3600)
+        if self.scheduler:
+            self.scheduler.schedule_next()
 
     def run(self):
         from resources.lib.player import BingebasePlayer
+        from resources.lib.scheduler import SyncScheduler
         from resources.lib.auth import is_connected, start_authorization
 
         log('Bingebase service starting')
@@ -98,10 +117,11 @@ class BingebaseService:
             self.player = BingebasePlayer(api=None)
             log('Not connected — scrobbling disabled')
 
+        self.scheduler = SyncScheduler(self.player)
+
         if get_setting_bool('sync_on_startup') and self.api:
             self._do_sync()
 
-        sync_check = 0
         while not self.monitor.abortRequested():
             self.player.update_time()
 
@@ -109,11 +129,9 @@ class BingebaseService:
                 self._sync_requested = False
                 self._do_sync()
 
-            sync_check += 5
-            if sync_check >= POLL_INTERVAL:
-                sync_check = 0
-                if self._should_scheduled_sync():
-                    self._do_sync()
+            if self.api and self.scheduler.should_run():
+                log('Running scheduled sync')
+                self._do_sync()
 
             if self.monitor.waitForAbort(5):
                 break
@@ -138,9 +156,9 @@ def main():
         if action == 'sync_now':
             from resources.lib.auth import is_connected
             if is_connected():
-                from resources.lib.api import BingebaseAPI
-                from resources.lib.sync import do_sync
-                do_sync(BingebaseAPI())
+                # Let the running service do the sync, so sync state is only
+                # ever changed from one process
+                xbmc.executebuiltin('NotifyAll({}, sync_now)'.format(ADDON_ID))
             else:
                 notify('Not connected to Bingebase')
             return
@@ -1,52 +1,86 @@
 import time
+from urllib.error import HTTPError
 
+from resources.lib.api import (
+    IMPORT_FORMAT_LEGACY, IMPORT_FORMAT_GROUPED, UNSUPPORTED_CODES, REJECTED_CODES
+)
+from resources.lib.governor import SyncGovernor, SyncAborted
+from resources.lib.pipeline import run_parallel, run_pipeline
+from resources.lib.tombstones import get_pending, acknowledge, compact_remote, record_remote_removal
 from resources.lib.utils import (
     get_setting, get_setting_bool, set_setting, jsonrpc,
-    get_show_uniqueids_by_tvshowid, log_error, notify
+    get_show_uniqueids_by_tvshowid, format_show_uniqueids, log, log_error, notify
 )
 
+# Items per import request
+IMPORT_CHUNK_SIZE = 1000
+
 
 def _to_kodi_datetime(iso_string):
     """Convert ISO 8601 (e.g. '2025-08-08T18:53:08Z') to Kodi format ('2025-08-08 18:53:08')."""
     return iso_string.replace('T', ' ').replace('Z', '')
 
 
-def get_watched_movies():
-    result = jsonrpc('VideoLibrary.GetMovies', {
+def _get_library_items(method, params, key, governor):
+    """Read a library listing page by page, checking in with the governor
+    between pages."""
+    items = []
+    while True:
+        governor.checkpoint()
+        start = len(items)
+        page_params = dict(params)
+        page_params['limits'] = {'start': start, 'end': start + governor.batch_size()}
+        result = jsonrpc(method, page_params)
+        if not result or key not in result:
+            break
+        items.extend(result[key])
+        total = result.get('limits', {}).get('total', 0)
+        if not result[key] or len(items) >= total:
+            break
+    return items
+
+
+def get_watched_movies(governor):
+    return _get_library_items('VideoLibrary.GetMovies', {
         'filter': {'field': 'playcount', 'operator': 'greaterthan', 'value': '0'},
         'properties': ['title', 'year', 'playcount', 'lastplayed', 'uniqueid'],
-    })
-    if result and 'movies' in result:
-        return result['movies']
-    return []
+    }, 'movies', governor)
 
 
-def get_watched_episodes():
-    result = jsonrpc('VideoLibrary.GetEpisodes', {
+def get_watched_episodes(governor):
+    return _get_library_items('VideoLibrary.GetEpisodes', {
         'filter': {'field': 'playcount', 'operator': 'greaterthan', 'value': '0'},
         'properties': ['title', 'showtitle', 'season', 'episode', 'playcount', 'lastplayed', 'uniqueid', 'tvshowid'],
-    })
-    if result and 'episodes' in result:
-        return result['episodes']
-    return []
+    }, 'episodes', governor)
 
 
-def get_all_movies():
-    result = jsonrpc('VideoLibrary.GetMovies', {
+def get_all_movies(governor):
+    return _get_library_items('VideoLibrary.GetMovies', {
         'properties': ['title', 'year', 'playcount', 'uniqueid'],
-    })
-    if result and 'movies' in result:
-        return result['movies']
-    return []
+    }, 'movies', governor)
 
 
-def get_all_episodes():
-    result = jsonrpc('VideoLibrary.GetEpisodes', {
+def get_all_episodes(governor):
+    return _get_library_items('VideoLibrary.GetEpisodes', {
         'properties': ['title', 'showtitle', 'season', 'episode', 'playcount', 'uniqueid'],
-    })
-    if result and 'episodes' in result:
-        return result['episodes']
-    return []
+    }, 'episodes', governor)
+
+
+def _governed_chunks(items, governor):
+    """Yield slices of items sized by the governor, checking in before each."""
+    start = 0
+    while start < len(items):
+        governor.checkpoint()
+        end = start + governor.batch_size()
+        yield items[start:end]
+        start = end
+
+
+def _format_in_chunks(items, formatter, governor):
+    formatted = []
+    for chunk in _governed_chunks(items, governor):
+        formatted.extend(formatter(item) for item in chunk)
+    return formatted
 
 
 def _format_movie_for_import(movie):
@@ -59,13 +93,15 @@ def _format_movie_for_import(movie):
     }
 
 
-def _format_episode_for_import(episode, show_uids_cache):
+def _get_show_uids(episode, show_uids_cache):
     # Look up show-level IDs, using cache to avoid repeated JSON-RPC calls
     tvshowid = episode.get('tvshowid')
     if tvshowid and tvshowid not in show_uids_cache:
         show_uids_cache[tvshowid] = get_show_uniqueids_by_tvshowid(tvshowid)
-    show_uids = show_uids_cache.get(tvshowid, {})
+    return format_show_uniqueids(show_uids_cache.get(tvshowid, {}))
+
 
+def _format_episode_for_import(episode, show_uids_cache):
     return {
         'title': episode.get('title', ''),
         'tvShowTitle': episode.get('showtitle', ''),
@@ -74,27 +110,124 @@ def _format_episode_for_import(episode, show_uids_cache):
         'playcount': episode.get('playcount', 1),
         'lastplayed': episode.get('lastplayed', ''),
         'uniqueIds': episode.get('uniqueid', {}),
-        'showUniqueIds': {
-            'tmdb': show_uids.get('tmdb', ''),
-            'tvdb': show_uids.get('tvdb', ''),
-            'imdb': show_uids.get('imdb', ''),
-        },
+        'showUniqueIds': _get_show_uids(episode, show_uids_cache),
     }
 
 
-def import_kodi_to_bingebase(api):
-    movies = get_watched_movies()
-    episodes = get_watched_episodes()
+def _group_episodes_for_import(episodes, show_uids_cache, governor):
+    """Group episodes by show so show metadata is sent once per show.
 
-    formatted_movies = [_format_movie_for_import(m) for m in movies]
+    Each show carries its title and ids plus a compact list of
+    [season, episode, playcount, lastplayed] rows.
+    """
+    shows = {}
+    for chunk in _governed_chunks(episodes, governor):
+        for episode in chunk:
+            key = episode.get('tvshowid') or episode.get('showtitle', '')
+            show = shows.get(key)
+            if show is None:
+                show = shows[key] = {
+                    'title': episode.get('showtitle', ''),
+                    'uniqueIds': _get_show_uids(episode, show_uids_cache),
+                    'episodes': [],
+                }
+            show['episodes'].append([
+                episode.get('season', 0),
+                episode.get('episode', 0),
+                episode.get('playcount', 1),
+                episode.get('lastplayed', ''),
+            ])
+    return list(shows.values())
+
+
+def _negotiate_import_format(api):
+    if IMPORT_FORMAT_GROUPED in api.get_import_formats():
+        return IMPORT_FORMAT_GROUPED
+    log('Server does not support grouped import, using legacy format')
+    return IMPORT_FORMAT_LEGACY
+
+
+def _chunked(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _grouped_import_chunks(movies, episodes, governor):
     show_uids_cache = {}
-    formatted_episodes = [_format_episode_for_import(e, show_uids_cache) for e in episodes]
+    for chunk in _chunked(movies, IMPORT_CHUNK_SIZE):
+        yield _format_in_chunks(chunk, _format_movie_for_import, governor), []
+    for chunk in _chunked(episodes, IMPORT_CHUNK_SIZE):
+        yield [], _group_episodes_for_import(chunk, show_uids_cache, governor)
+
 
-    if not formatted_movies and not formatted_episodes:
+def _legacy_import_chunks(movies, episodes, governor):
+    show_uids_cache = {}
+    for chunk in _chunked(movies, IMPORT_CHUNK_SIZE):
+        yield _format_in_chunks(chunk, _format_movie_for_import, governor), []
+    for chunk in _chunked(episodes, IMPORT_CHUNK_SIZE):
+        yield [], _format_in_chunks(
+            chunk, lambda e: _format_episode_for_import(e, show_uids_cache), governor)
+
+
+def _push_removals_one_by_one(api, pending):
+    """Resend removals individually after a batch was rejected, dropping the
+    entries the server refuses so they aren't retried forever."""
+    for entry in pending:
+        try:
+            api.remove_history([entry])
+        except HTTPError as e:
+            if e.code not in REJECTED_CODES:
+                raise
+            log_error('Server rejected removal of {}, dropping it'.format(entry.get('title', '')))
+        acknowledge(entry['seq'])
+    return len(pending)
+
+
+def push_removals_to_bingebase(api):
+    """Send pending Kodi un-watches and compact the acknowledged entries."""
+    pending = get_pending()
+    if not pending:
+        return 0
+
+    try:
+        response = api.remove_history(pending)
+    except HTTPError as e:
+        if e.code in UNSUPPORTED_CODES:
+            log('Server does not accept removals yet, keeping {} pending'.format(len(pending)))
+            return 0
+        if e.code in REJECTED_CODES:
+            return _push_removals_one_by_one(api, pending)
+        raise
+
+    acked = pending[-1]['seq']
+    if response and 'ack' in response:
+        acked = min(acked, int(response['ack']))
+    acknowledge(acked)
+    return len(pending)
+
+
+def import_kodi_to_bingebase(api, governor):
+    # The format is settled before uploading so no chunk is ever resent
+    movies, episodes, import_format = run_parallel(
+        governor,
+        lambda: get_watched_movies(governor),
+        lambda: get_watched_episodes(governor),
+        lambda: _negotiate_import_format(api),
+    )
+
+    if not movies and not episodes:
         return 0, 0
 
-    api.import_history(formatted_movies, formatted_episodes)
-    return len(formatted_movies), len(formatted_episodes)
+    if import_format == IMPORT_FORMAT_GROUPED:
+        chunks = _grouped_import_chunks(movies, episodes, governor)
+        upload = api.import_history_grouped
+    else:
+        chunks = _legacy_import_chunks(movies, episodes, governor)
+        upload = api.import_history
+
+    # Each chunk is uploaded while the next one is being formatted
+    run_pipeline(chunks, lambda chunk: upload(*chunk), governor)
+    return len(movies), len(episodes)
 
 
 def _extract_uniqueids(item):
@@ -125,69 +258,109 @@ def _find_kodi_item(kodi_items, uniqueids):
     return None
 
 
-def export_bingebase_to_kodi(api, since=None):
-    data = api.export_history(since=since)
+def export_bingebase_to_kodi(api, governor, since=None):
+    # Read the local library while the export downloads
+    data, kodi_movies, kodi_episodes = run_parallel(
+        governor,
+        lambda: api.export_history(since=since),
+        lambda: get_all_movies(governor),
+        lambda: get_all_episodes(governor),
+    )
 
     if not data:
         return 0
 
     bb_movies = data.get('movies', [])
     bb_episodes = data.get('episodes', [])
-    kodi_movies = get_all_movies()
-    kodi_episodes = get_all_episodes()
     marked_count = 0
 
-    for movie in bb_movies:
-        uids = _extract_uniqueids(movie)
-        match = _find_kodi_item(kodi_movies, uids)
-        if match and match.get('playcount', 0) == 0:
-            params = {
-                'movieid': match['movieid'],
-                'playcount': 1,
-            }
-            watched_at = movie.get('watched_at', '')
-            if watched_at:
-                params['lastplayed'] = _to_kodi_datetime(watched_at)
-            jsonrpc('VideoLibrary.SetMovieDetails', params)
-            marked_count += 1
-
-    for episode in bb_episodes:
-        uids = _extract_uniqueids(episode)
-        match = _find_kodi_item(kodi_episodes, uids)
-        if match and match.get('playcount', 0) == 0:
-            params = {
-                'episodeid': match['episodeid'],
-                'playcount': 1,
-            }
-            watched_at = episode.get('watched_at', '')
-            if watched_at:
-                params['lastplayed'] = _to_kodi_datetime(watched_at)
-            jsonrpc('VideoLibrary.SetEpisodeDetails', params)
-            marked_count += 1
+    for chunk in _governed_chunks(bb_movies, governor):
+        for movie in chunk:
+            uids = _extract_uniqueids(movie)
+            match = _find_kodi_item(kodi_movies, uids)
+            if match and match.get('playcount', 0) == 0:
+                params = {
+                    'movieid': match['movieid'],
+                    'playcount': 1,
+                }
+                watched_at = movie.get('watched_at', '')
+                if watched_at:
+                    params['lastplayed'] = _to_kodi_datetime(watched_at)
+                jsonrpc('VideoLibrary.SetMovieDetails', params)
+                marked_count += 1
+
+    for chunk in _governed_chunks(bb_episodes, governor):
+        for episode in chunk:
+            uids = _extract_uniqueids(episode)
+            match = _find_kodi_item(kodi_episodes, uids)
+            if match and match.get('playcount', 0) == 0:
+                params = {
+                    'episodeid': match['episodeid'],
+                    'playcount': 1,
+                }
+                watched_at = episode.get('watched_at', '')
+                if watched_at:
+                    params['lastplayed'] = _to_kodi_datetime(watched_at)
+                jsonrpc('VideoLibrary.SetEpisodeDetails', params)
+                marked_count += 1
+
+    removed = data.get('removed', {})
+    marked_count += _apply_removals(
+        removed.get('movies', []), kodi_movies, 'movie', 'VideoLibrary.SetMovieDetails', governor)
+    marked_count += _apply_removals(
+        removed.get('episodes', []), kodi_episodes, 'episode', 'VideoLibrary.SetEpisodeDetails', governor)
 
     return marked_count
 
 
-def do_sync(api):
+def _apply_removals(bb_items, kodi_items, media_type, method, governor):
+    """Mark items un-watched on Bingebase as unwatched in Kodi."""
+    id_key = '{}id'.format(media_type)
+    count = 0
+    for chunk in _governed_chunks(bb_items, governor):
+        for item in chunk:
+            uids = _extract_uniqueids(item)
+            match = _find_kodi_item(kodi_items, uids)
+            if match and match.get('playcount', 0) > 0:
+                record_remote_removal(media_type, match[id_key], uids)
+                jsonrpc(method, {id_key: match[id_key], 'playcount': 0, 'lastplayed': ''})
+                count += 1
+    return count
+
+
+def do_sync(api, governor=None):
     notify('Syncing...')
+    governor = governor or SyncGovernor()
 
     try:
+        compact_remote()
+
         if get_setting_bool('sync_kodi_to_bingebase'):
-            import_kodi_to_bingebase(api)
+            push_removals_to_bingebase(api)
 
         last_sync = _get_last_sync_timestamp()
 
+        # Export first so items un-watched on Bingebase are already reset in
+        # Kodi and aren't re-imported as watched
         if get_setting_bool('sync_bingebase_to_kodi'):
-            export_bingebase_to_kodi(api, since=last_sync)
+            export_bingebase_to_kodi(api, governor, since=last_sync)
+
+        if get_setting_bool('sync_kodi_to_bingebase'):
+            import_kodi_to_bingebase(api, governor)
 
         _save_last_sync_timestamp()
         notify('Sync complete')
 
+    except SyncAborted:
+        log('Sync cancelled')
+
     except Exception:
         log_error('Sync failed')
         import xbmcgui
         notify('Sync failed', icon=xbmcgui.NOTIFICATION_ERROR)
 
+    governor.log_metrics()
+
 
 def _get_last_sync_timestamp():
     ts = get_setting('last_sync_timestamp')
@@ -0,0 +1,164 @@
+import json
+import os
+import threading
+
+from resources.lib.utils import (
+    get_profile_path, get_show_uniqueids_by_tvshowid, format_show_uniqueids, jsonrpc, log_error
+)
+
+CHANGE_LOG_FILE = 'changelog.json'
+
+# Where a removal came from: un-watched in Kodi, to be sent to Bingebase, or
+# un-watched on Bingebase and applied to Kodi
+ORIGIN_LOCAL = 'local'
+ORIGIN_REMOTE = 'remote'
+
+# Every change happens in the service process (sync_now is handed over to it
+# too), so a thread lock is enough to serialize read-modify-write cycles
+_lock = threading.Lock()
+
+
+def _load():
+    try:
+        with open(get_profile_path(CHANGE_LOG_FILE), 'r') as f:
+            return json.load(f)
+    except (IOError, OSError):
+        pass
+    except ValueError:
+        log_error('Change log is unreadable, starting a new one')
+    return {'seq': 0, 'entries': []}
+
+
+def _save(changes):
+    # Write a temp file and swap it in, so a crash mid-write can't leave a
+    # truncated log behind
+    path = get_profile_path(CHANGE_LOG_FILE)
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(changes, f, separators=(',', ':'))
+        os.replace(tmp_path, path)
+    except (IOError, OSError):
+        log_error('Failed to write change log')
+
+
+def _get_item_details(media_type, dbid):
+    if media_type == 'movie':
+        result = jsonrpc('VideoLibrary.GetMovieDetails', {
+            'movieid': dbid,
+            'properties': ['title', 'year', 'uniqueid'],
+        })
+        if not result or 'moviedetails' not in result:
+            return None
+        details = result['moviedetails']
+        return {
+            'title': details.get('title', ''),
+            'year': details.get('year', 0),
+            'uniqueIds': details.get('uniqueid', {}),
+        }
+
+    result = jsonrpc('VideoLibrary.GetEpisodeDetails', {
+        'episodeid': dbid,
+        'properties': ['title', 'showtitle', 'season', 'episode', 'uniqueid', 'tvshowid'],
+    })
+    if not result or 'episodedetails' not in result:
+        return None
+    details = result['episodedetails']
+    show_uids = get_show_uniqueids_by_tvshowid(details['tvshowid']) if details.get('tvshowid') else {}
+    return {
+        'title': details.get('title', ''),
+        'tvShowTitle': details.get('showtitle', ''),
+        'season': details.get('season', 0),
+        'episode': details.get('episode', 0),
+        'uniqueIds': details.get('uniqueid', {}),
+        'showUniqueIds': format_show_uniqueids(show_uids),
+    }
+
+
+def _drop(entries, media_type, dbid):
+    return [e for e in entries if not (e['mediaType'] == media_type and e['dbid'] == dbid)]
+
+
+def _is_remote(entry):
+    return entry.get('origin') == ORIGIN_REMOTE
+
+
+def _append(changes, entry):
+    # Only the latest change per item is kept
+    changes['seq'] += 1
+    entry['seq'] = changes['seq']
+    changes['entries'] = _drop(changes['entries'], entry['mediaType'], entry['dbid']) + [entry]
+
+
+def record_unwatched(media_type, dbid):
+    """Record that an item's playcount was reset to 0 in Kodi.
+
+    A reset caused by applying a Bingebase removal compacts that removal's
+    entry instead, so it isn't echoed back to the server.
+    """
+    details = _get_item_details(media_type, dbid)
+    if details is None:
+        return
+
+    with _lock:
+        changes = _load()
+        entries = _drop(changes['entries'], media_type, dbid)
+        if any(_is_remote(e) and e['mediaType'] == media_type and e['dbid'] == dbid
+               for e in changes['entries']):
+            changes['entries'] = entries
+            _save(changes)
+            return
+
+        details.update({'origin': ORIGIN_LOCAL, 'mediaType': media_type, 'dbid': dbid})
+        _append(changes, details)
+        _save(changes)
+
+
+def record_watched(media_type, dbid):
+    """Drop any pending removal for an item that was watched again."""
+    with _lock:
+        changes = _load()
+        entries = _drop(changes['entries'], media_type, dbid)
+        if len(entries) != len(changes['entries']):
+            changes['entries'] = entries
+            _save(changes)
+
+
+def record_remote_removal(media_type, dbid, uniqueids):
+    """Record a Bingebase removal that is about to be applied to an item."""
+    with _lock:
+        changes = _load()
+        _append(changes, {
+            'origin': ORIGIN_REMOTE,
+            'mediaType': media_type,
+            'dbid': dbid,
+            'uniqueIds': uniqueids,
+        })
+        _save(changes)
+
+
+def compact_remote():
+    """Drop remote entries left from earlier syncs. Kodi has reported their
+    playcount resets by now, so there is nothing left to suppress."""
+    with _lock:
+        changes = _load()
+        entries = [e for e in changes['entries'] if not _is_remote(e)]
+        if len(entries) != len(changes['entries']):
+            changes['entries'] = entries
+            _save(changes)
+
+
+def get_pending():
+    """Kodi removals not yet acknowledged by the server, oldest first."""
+    with _lock:
+        changes = _load()
+    return [{k: v for k, v in e.items() if k not in ('dbid', 'origin')}
+            for e in changes['entries'] if not _is_remote(e)]
+
+
+def acknowledge(seq):
+    """Compact the log by dropping Kodi removals up to and including seq."""
+    with _lock:
+        changes = _load()
+        changes['entries'] = [e for e in changes['entries'] if _is_remote(e) or e['seq'] > seq]
+        _save(changes)
@@ -1,8 +1,10 @@
 import json
+import os
 
 import xbmc
 import xbmcaddon
 import xbmcgui
+import xbmcvfs
 
 ADDON = xbmcaddon.Addon()
 ADDON_ID = ADDON.getAddonInfo('id')
@@ -30,6 +32,14 @@ def set_setting(setting_id, value):
     ADDON.setSetting(setting_id, str(value))
 
 
+def get_profile_path(filename):
+    """Path to a file in the addon's profile (addon_data) directory."""
+    profile = xbmcvfs.translatePath(ADDON.getAddonInfo('profile'))
+    if not xbmcvfs.exists(profile):
+        xbmcvfs.mkdirs(profile)
+    return os.path.join(profile, filename)
+
+
 def log(message, level=xbmc.LOGINFO):
     xbmc.log('[{}] {}'.format(ADDON_ID, message), level=level)
 
@@ -83,6 +93,15 @@ def get_show_uniqueids_by_tvshowid(tvshowid):
     return {}
 
 
+def format_show_uniqueids(show_uids):
+    """Shape a show's uniqueids as the showUniqueIds dict Bingebase expects."""
+    return {
+        'tmdb': show_uids.get('tmdb', ''),
+        'tvdb': show_uids.get('tvdb', ''),
+        'imdb': show_uids.get('imdb', ''),
+    }
+
+
 def get_show_uniqueids(episode_db_id):
     """Get the parent TV show's uniqueids for an episode."""
     result = jsonrpc('VideoLibrary.GetEpisodeDetails', {